@@ -1,22 +1,20 @@
 #!/usr/bin/python3
-from tomlkit import comment, document, nl, string as tkstring, table
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 from argparse import ArgumentParser
-from os import makedirs, fdatasync
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs
+from typing import Dict, List, Optional, Tuple
 from os.path import basename
 from pathlib import Path
 import logging
+import mmap
+import os
+import stat
 import string
 import sys
 
 log = logging.getLogger("__name__")
 
-def _log_debug_harder(*args, **kwargs):
-    if _DEBUG_HARDER:
-        _log_debug(*args, **kwargs)
-
-
 _log_debug = log.debug
 _log_info = log.info
 _log_warn = log.warning
@@ -27,25 +25,83 @@ console_handler.setLevel(logging.INFO)
 console_handler.setFormatter(formatter)
 log.addHandler(console_handler)
 
+# Set from --verbose: guards debug calls on the per-line parsing path so
+# that the default run does not pay for building their arguments.
+_DEBUG_ENABLED = False
 _DEBUG_HARDER = False
 
 _DB_TOP_DIR = Path("parameters/kernel")
 
-
-@dataclass
+# Definitions are small and independent: overlap their I/O across threads.
+_WRITE_WORKERS = 16
+
+# Characters that may begin a parameter or sub-parameter name.
+_PARAM_CHARS = frozenset(string.ascii_letters + string.digits)
+
+# Parsed flag tuples keyed by their "[...]" source text.
+_FLAG_CACHE: Dict[str, Tuple[str, ...]] = {}
+
+# Whitespace and quoting stripped from each enum value.
+_VALUE_STRIP_CHARS = "\t \"'"
+
+# The definition.toml schema is fixed, so documents are rendered from a
+# template rather than built up as a TOML document object. Values are
+# pre-formatted TOML: see _toml_string() and _toml_literal().
+# FIXME: format and allow_empty are not derived from the parameter yet.
+_DEFINITION_TEMPLATE = """\
+# This is a libKCmdline definition document.
+
+title = {title}
+name = {name}
+processor = "kernel"
+description = {description}
+
+[syntax]
+type = {fmt}
+format = {fmt}
+choices = [{choices}]
+allow_empty = true
+"""
+
+# Escapes for TOML basic strings: quote, backslash and control characters.
+_TOML_ESCAPES = str.maketrans(
+    {
+        **{chr(c): f"\\u{c:04x}" for c in [*range(0x20), 0x7F]},
+        "\b": "\\b",
+        "\t": "\\t",
+        "\n": "\\n",
+        "\f": "\\f",
+        "\r": "\\r",
+        '"': '\\"',
+        "\\": "\\\\",
+    }
+)
+
+# Characters that cannot appear in a TOML multi-line literal string.
+_TOML_LITERAL_INVALID = frozenset(
+    chr(c) for c in [*range(0x20), 0x7F] if chr(c) not in "\t\n\r"
+)
+
+
+@dataclass(slots=True)
 class Param:
     name: str = "INVALID"
-    flags: List[str] = field(default_factory=list)
+    flags: Optional[Tuple[str, ...]] = None
     desc: str = ""
     fmt: str = ""
-    values: List[str] = field(default_factory=list)
-    subparams: Dict[str, "Param"] = field(default_factory=dict)
+    # Most parameters have neither: created on first use.
+    values: Optional[List[str]] = None
+    subparams: Optional[Dict[str, "Param"]] = None
 
 
-def parse_flags(flags: str) -> List[str]:
-    flags = flags.lstrip("[")
-    flags = flags.strip("]")
-    return flags.split(",")
+def parse_flags(flags: str) -> Tuple[str, ...]:
+    # The same few flag sets recur across thousands of parameters: share
+    # one interned tuple per distinct "[...]" string.
+    cached = _FLAG_CACHE.get(flags)
+    if cached is None:
+        names = flags.lstrip("[").strip("]").split(",")
+        cached = _FLAG_CACHE[flags] = tuple(sys.intern(name) for name in names)
+    return cached
 
 
 def parse_values(values: str) -> List[str]:
@@ -55,222 +111,283 @@ def parse_values(values: str) -> List[str]:
         values = values.replace("{ {", "{")
 
     sep = "|" if "|" in values else ","
-    return list(map(lambda x: x.strip("\t \"'"), values.strip("{}").split(sep)))
+    return [value.strip(_VALUE_STRIP_CHARS) for value in values.strip("{}").split(sep)]
+
+
+def _toml_string(value: str) -> str:
+    return '"' + value.translate(_TOML_ESCAPES) + '"'
+
 
+def _toml_literal(value: str) -> str:
+    # Multi-line literal strings have no escapes: refuse what they cannot hold.
+    if "'''" in value or not _TOML_LITERAL_INVALID.isdisjoint(value):
+        raise ValueError(f"Cannot encode TOML literal string: {value!r}")
+    # A newline straight after the opening delimiter is dropped by TOML
+    # parsers: emit an extra one so a leading newline in the value survives.
+    if value[:1] in ("\n", "\r"):
+        value = "\n" + value
+    return "'''" + value + "'''"
 
-def process_kernel_parameters(kernel_params: Path):
+
+def join_desc(lines: List[str]) -> str:
+    # Blank lines are collected as empty entries: drop any leading ones.
+    return "\n".join(lines).lstrip("\n")
+
+
+def process_kernel_parameters(kernel_params: Path) -> Dict[str, Param]:
     _log_info("Proccessing path: %s", kernel_params)
-    param_chars = string.ascii_letters + string.digits
-    params = {}
+    params: Dict[str, Param] = {}
     line_count = 0
-    with open(kernel_params, "r", encoding="utf8") as fp:
-        param = None
-        subparam = None
-        format_line = None
-        while line := fp.readline():
-            line_count += 1
 
-            _log_debug_harder(
-                "processing line %d: %s, %s, %s",
+    # Loop invariants bound to locals for the per-line hot path.
+    add_param = params.__setitem__
+    param_chars = _PARAM_CHARS
+    debug = _DEBUG_ENABLED
+    debug_harder = _DEBUG_HARDER
+
+    def complete_subparam(
+        param: Param, subparam: Param, subdesc_lines: List[str], line_count: int
+    ):
+        subparam.desc = join_desc(subdesc_lines)
+        subparam.fmt = sys.intern(subparam.fmt)
+        if debug:
+            _log_debug(
+                "[%04d] Completing SUB-parameter %s (desc=%s, flags=%s, fmt=%s, values=%s)",
+                line_count,
+                subparam.name,
+                subparam.desc,
+                subparam.flags,
+                subparam.fmt,
+                subparam.values,
+            )
+        if param.subparams is None:
+            param.subparams = {}
+        param.subparams[subparam.name] = subparam
+
+    def complete_param(param: Param, desc_lines: List[str], line_count: int):
+        if not param.fmt:
+            param.fmt = "complex" if param.subparams else "flag"
+        # A handful of formats ("flag", "enum", "<int>", ...) cover most
+        # parameters.
+        param.fmt = sys.intern(param.fmt)
+        param.desc = join_desc(desc_lines)
+        if debug:
+            _log_debug(
+                "[%04d] Completing PARAMETER %s (flags=%s, fmt=%s, values=%s)",
                 line_count,
-                param,
-                subparam,
-                format_line
+                param.name,
+                param.flags,
+                param.fmt,
+                param.values,
             )
+        add_param(param.name, param)
+
+    with open(kernel_params, "rb") as fp:
+        st = os.fstat(fp.fileno())
+        if stat.S_ISREG(st.st_mode) and st.st_size:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+                # Decode straight from the mapping: no intermediate bytes copy.
+                text = str(mm, "utf8")
+        else:
+            # Empty files cannot be mapped, nor can pipes and FIFOs.
+            text = str(fp.read(), "utf8")
+        # Translate line endings as a text mode open() would.
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        # Split on "\n" only, as readline() did: splitlines() would also
+        # break lines at form feeds and other Unicode line boundaries.
+        # Lines are kept without their newline: blank lines are empty.
+        lines = text.split("\n")
+        # A final newline leaves an empty remainder, not a blank line.
+        if not lines[-1]:
+            lines.pop()
+        param: Optional[Param] = None
+        subparam: Optional[Param] = None
+        flags: Optional[Tuple[str, ...]]
+        # Description and multi-line Format: enum text are collected
+        # line-by-line and joined once, rather than grown with +=.
+        desc_lines: List[str] = []
+        subdesc_lines: List[str] = []
+        format_lines: List[str] = []
+        for line in lines:
+            line_count += 1
+            stripped = line.lstrip("\t")
+            depth = len(line) - len(stripped)
+            leader = stripped[:1]
+
+            if debug_harder:
+                _log_debug(
+                    "processing line %d: %s, %s, %s",
+                    line_count,
+                    param,
+                    subparam,
+                    format_lines
+                )
 
-            if line == "\n" and (param or subparam):
+            if not line and (param or subparam):
                 if subparam:
-                    subparam.desc += "\n"
+                    subdesc_lines.append("")
                 else:
-                    param.desc += "\n"
+                    desc_lines.append("")
 
-            if line.startswith("\t") and line[1] in param_chars:
+            if depth == 1 and leader in param_chars:
                 # Complete any open sub-param before completing parma
                 if subparam:
-                    if subparam.desc.startswith("\n"):
-                        subparam.desc = subparam.desc.lstrip("\n")
-                    _log_debug(
-                        "[%04d] Completing SUB-parameter %s (desc=%s, flags=%s, fmt=%s, values=%s)",
-                        line_count,
-                        subparam.name,
-                        subparam.desc,
-                        subparam.flags,
-                        subparam.fmt,
-                        subparam.values,
-                    )
-                    param.subparams[subparam.name] = subparam
+                    # Sub-parameters are only ever opened under a parameter.
+                    assert param is not None
+                    complete_subparam(param, subparam, subdesc_lines, line_count)
                     subparam = None
                 # Complete last Param object.
                 if param:
-                    if not param.fmt and not param.subparams:
-                        param.fmt = "flag"
-                    elif not param.fmt and param.subparams:
-                        param.fmt = "complex"
-                    if param.desc.startswith("\n"):
-                        param.desc = param.desc.lstrip("\n")
-                    _log_debug(
-                        "[%04d] Completing PARAMETER %s (flags=%s, fmt=%s, values=%s)",
-                        line_count,
-                        param.name,
-                        param.flags,
-                        param.fmt,
-                        param.values,
-                    )
-                    params[param.name] = param
+                    complete_param(param, desc_lines, line_count)
                     param = None
                 # New parameter: get name, maybe fmt, flags and desc
                 parts = line.split(maxsplit=2)
-                name = parts[0]
-                name_parts = name.split("=", maxsplit=1)
-                name = name_parts[0]
+                name, _, fmt = parts[0].partition("=")
+                # Names key the params dicts and the output paths: intern
+                # them so that the repeated hashing is cached.
+                name = sys.intern(name)
                 # Ugggh..
-                if name == "sdw_mclk_divider" and name_parts[1] == "[SDW]":
-                    flags = parse_flags(name_parts[1])
+                if name == "sdw_mclk_divider" and fmt == "[SDW]":
+                    flags = parse_flags(fmt)
                     fmt = "<int>"
                 else:
                     flags = parse_flags(parts[1]) if len(parts) > 1 else None
-                    fmt = (
-                        name_parts[1] if len(name_parts) == 2 and name_parts[1] else ""
-                    )
                 desc = parts[2].strip() if len(parts) > 2 else ""
-                _log_debug(
-                    "[%04d] New PARAMETER: %s, flags=%s, desc=%s, fmt=%s",
-                    line_count,
-                    name if f"{name}=" not in line else f"{name}=",
-                    flags,
-                    desc,
-                    fmt,
-                )
-                param = Param(name=name, flags=flags, desc=desc, fmt=fmt)
-
-            if param and line.startswith("\t\t") and line[2] in param_chars:
-                line = line.removeprefix("\t\t\t").rstrip()
-                if subparam:
-                    if subparam.desc.startswith("\n"):
-                        subparam.desc = subparam.desc.lstrip("\n")
+                if debug:
                     _log_debug(
-                        "[%04d] Completing SUB-parameter %s (desc=%s, flags=%s, fmt=%s, values=%s)",
+                        "[%04d] New PARAMETER: %s, flags=%s, desc=%s, fmt=%s",
                         line_count,
-                        subparam.name,
-                        subparam.desc,
-                        subparam.flags,
-                        subparam.fmt,
-                        subparam.values,
+                        name if f"{name}=" not in line else f"{name}=",
+                        flags,
+                        desc,
+                        fmt,
                     )
-                    param.subparams[subparam.name] = subparam
+                param = Param(name=name, flags=flags, fmt=fmt)
+                desc_lines = [desc]
+
+            elif param and depth == 2 and leader in param_chars:
+                line = stripped.rstrip()
+                if subparam:
+                    complete_subparam(param, subparam, subdesc_lines, line_count)
                     subparam = None
                 # New parameter: get name, maybe fmt, flags and desc
                 parts = line.split(maxsplit=2)
-                name = parts[0]
-                name_parts = name.split("=", maxsplit=2)
-                name = name_parts[0]
+                name, _, fmt = parts[0].partition("=")
+                name = sys.intern(name)
+                # A name with more than one "=" has no usable format.
+                if "=" in fmt:
+                    fmt = ""
                 flags = (
                     parse_flags(parts[1])
                     if (len(parts) > 1 and parts[1].startswith("["))
                     else None
                 )
-                fmt = (
-                    name_parts[1]
-                    if (len(name_parts) == 2 and name_parts[1] and "=" in line)
-                    else ""
-                )
-                desc = " ".join(parts[1:]).strip() if len(parts) > 2 else ""
-                _log_debug(
-                    "[%04d] New SUB-parameter: %s, flags=%s, desc=%s, fmt=%s",
-                    line_count,
-                    name,
-                    flags,
-                    desc,
-                    fmt,
-                )
-                subparam = Param(name=name, flags=flags, desc=desc, fmt=fmt)
-
-            if param and subparam and line.startswith("\t\t\t\t"):
-                line = line.removeprefix("\t\t\t\t").rstrip()
-                _log_debug(
-                    "[%04d] Continuing description for SUBparam %s: %s",
-                    line_count,
-                    subparam.name,
-                    line,
-                )
-                subparam.desc += "\n" + line
+                # The line was right-stripped and split() drops the leading
+                # whitespace of the remainder: no further strip() needed.
+                desc = f"{parts[1]} {parts[2]}" if len(parts) > 2 else ""
+                if debug:
+                    _log_debug(
+                        "[%04d] New SUB-parameter: %s, flags=%s, desc=%s, fmt=%s",
+                        line_count,
+                        name,
+                        flags,
+                        desc,
+                        fmt,
+                    )
+                subparam = Param(name=name, flags=flags, fmt=fmt)
+                subdesc_lines = [desc]
 
-            if param and subparam and line.startswith("\t\t\t"):
-                line = line.removeprefix("\t\t\t").rstrip()
-                _log_debug(
-                    "[%04d] Continuing description for SUBparam %s: %s",
-                    line_count,
-                    subparam.name,
-                    line,
-                )
-                subparam.desc += "\n" + line
+            elif param and subparam and depth >= 3:
+                # Sub-parameter descriptions are indented by three or four tabs.
+                line = line[min(depth, 4):].rstrip()
+                if debug:
+                    _log_debug(
+                        "[%04d] Continuing description for SUBparam %s: %s",
+                        line_count,
+                        subparam.name,
+                        line,
+                    )
+                subdesc_lines.append(line)
 
-            if param and line.startswith("\t\t\t"):
-                line = line.removeprefix("\t\t\t").rstrip()
+            elif param and depth >= 3:
+                # Keep any tabs beyond the third: continuation lines of
+                # multi-line Format: blocks are indented further.
+                line = line[3:].rstrip()
 
                 # Handle Format: lines with or without {...} enum values.
-                if line.startswith("Format: ") or line.startswith("{"):
-                    if line.startswith("Format: "):
-                        line = line.removeprefix("Format: ")
-                        if "{" not in line and "}" not in line and format_line is None:
+                if line.startswith("Format: "):
+                    line = line[len("Format: "):]
+                    if "{" not in line and "}" not in line and not format_lines:
+                        if debug:
                             _log_debug(
                                 "[%04d] Found in-line format descroption: %s",
                                 line_count,
                                 line,
                             )
-                            param.fmt = line
-                            continue
-
-                # Glue format lines between {..[|,]..} together
-                if (
-                    line.startswith("{")
-                    and ("|" in line or "," in line)
-                    and line.endswith("}")
-                ):
-                    param.values = parse_values(line)
-                    param.fmt = "enum"
-                    _log_debug(
-                        "[%04d] Handling one-line enum block {...} %s",
-                        line_count,
-                        param.values,
-                    )
-                elif line.startswith("{") and ("|" in line or "," in line):
-                    _log_debug(
-                        "[%04d] Entering Format enum block {...: %s", line_count, line
-                    )
-                    format_line = line
-                elif (
-                    format_line and ("|" in line or "," in line) and line.endswith("}")
-                ):
-                    format_line += line
-                    param.values = parse_values(format_line)
-                    param.fmt = "enum"
-                    _log_debug(
-                        "[%04d] Exiting Format enum block ...} %s",
-                        line_count,
-                        param.values,
-                    )
-                    format_line = None
-                elif format_line and ("|" in line or "," in line):
-                    _log_debug(
-                        "[%04d] Continuing Format enum block ..[|,].. %s",
-                        line_count,
-                        line,
-                    )
-                    format_line += line
-                elif line.startswith("{") and line.endswith("}"):
-                    _log_debug(
-                        "[%04d] Handling non-enum format line: %s", line_count, line
-                    )
+                        param.fmt = line
+                        continue
+
+                # Glue format lines between {..[|,]..} together. Only lines
+                # opening a {...} block, or inside one, need classifying.
+                opens = line.startswith("{")
+                has_sep = closes = False
+                if opens or format_lines:
+                    has_sep = "|" in line or "," in line
+                    closes = line.endswith("}")
+
+                if opens and has_sep:
+                    if closes:
+                        param.values = parse_values(line)
+                        param.fmt = "enum"
+                        if debug:
+                            _log_debug(
+                                "[%04d] Handling one-line enum block {...} %s",
+                                line_count,
+                                param.values,
+                            )
+                    else:
+                        if debug:
+                            _log_debug(
+                                "[%04d] Entering Format enum block {...: %s",
+                                line_count,
+                                line,
+                            )
+                        format_lines = [line]
+                elif format_lines and has_sep:
+                    format_lines.append(line)
+                    if closes:
+                        param.values = parse_values("".join(format_lines))
+                        param.fmt = "enum"
+                        if debug:
+                            _log_debug(
+                                "[%04d] Exiting Format enum block ...} %s",
+                                line_count,
+                                param.values,
+                            )
+                        format_lines = []
+                    elif debug:
+                        _log_debug(
+                            "[%04d] Continuing Format enum block ..[|,].. %s",
+                            line_count,
+                            line,
+                        )
+                elif opens and closes:
+                    if debug:
+                        _log_debug(
+                            "[%04d] Handling non-enum format line: %s", line_count, line
+                        )
                     param.fmt = line.strip("{}")
                 else:
-                    _log_debug(
-                        "[%04d] Continuing description for param %s: %s",
-                        line_count,
-                        param.name,
-                        line,
-                    )
-                    param.desc += "\n" + line.lstrip()
+                    if debug:
+                        _log_debug(
+                            "[%04d] Continuing description for param %s: %s",
+                            line_count,
+                            param.name,
+                            line,
+                        )
+                    desc_lines.append(line.lstrip())
     return params
 
 def write_kernel_parameter(param: Param, db_dir: Path):
@@ -278,37 +395,61 @@ def write_kernel_parameter(param: Param, db_dir: Path):
     makedirs(param_dir, exist_ok=True)
     param_file = param_dir / "definition.toml"
 
-    if param_file.exists():
-        param_file.unlink()
-
-    doc = document()
-    doc.add(comment("This is a libKCmdline definition document."))
-    doc.add(nl())
-    doc.add("title", f"{param.name} - definition.toml")
-    doc.add("name", param.name)
-    doc.add("processor", "kernel")
-    doc.add("description", tkstring(param.desc, literal=True, multiline=True))
-    syntax = table()
-    syntax.add("type", param.fmt)
-    syntax.add("format", param.fmt)  # FIXME
-    syntax.add("choices", param.values)
-    syntax.add("allow_empty", True)  # FIXME
-    doc.add("syntax", syntax)
-
-    with open(param_dir / "definition.toml", "w", encoding="utf8") as fd:
-        fd.write(doc.as_string())
-        fd.flush()
-        fdatasync(fd.fileno())
+    data = _DEFINITION_TEMPLATE.format(
+        title=_toml_string(f"{param.name} - definition.toml"),
+        name=_toml_string(param.name),
+        description=_toml_literal(param.desc),
+        fmt=_toml_string(param.fmt),
+        choices=", ".join(_toml_string(value) for value in param.values or []),
+    )
+
+    encoded = data.encode("utf8")
+
+    # Leave definitions that are already up to date alone: re-reading a
+    # small file is far cheaper than rewriting it. Compare bytes, so that
+    # e.g. CRLF line endings on disk still count as a change.
+    try:
+        current = param_file.read_bytes()
+    except FileNotFoundError:
+        current = None
+
+    if current != encoded:
+        fd = os.open(param_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            # write(2) may be short (e.g. as the disk fills): keep going
+            # until it either completes or raises.
+            buf = memoryview(encoded)
+            while buf:
+                buf = buf[os.write(fd, buf):]
+        finally:
+            os.close(fd)
+    else:
+        _log_debug("Skipping unchanged parameter '%s'", param.name)
+    if not param.subparams:
+        return
     for (subname, subparam) in param.subparams.items():
         _log_debug("Writing subparameter '%s'", subname)
         write_kernel_parameter(subparam, param_dir)
 
 
-def write_kernel_parameters(params: List[Param], db_dir: Path):
-    for (name, param) in params.items():
-        _log_debug("Writing parameter '%s'", name)
+def write_kernel_parameters(
+    params: Dict[str, Param], db_dir: Path, durable: bool = False
+):
+    def _write(param: Param):
+        _log_debug("Writing parameter '%s'", param.name)
+        # Sub-parameters are written by the same task, after their parent.
         write_kernel_parameter(param, db_dir)
 
+    with ThreadPoolExecutor(max_workers=_WRITE_WORKERS) as pool:
+        # Consume the results so that any write error is raised here.
+        list(pool.map(_write, params.values()))
+
+    # The database can always be regenerated, so writeback is left to the
+    # kernel unless asked otherwise. A single sync at the end also covers
+    # definitions that were left unchanged by an earlier, unsynced run.
+    if durable:
+        os.sync()
+
 
 def dump_kernel_parameter(param: Param):
     print(f"  Name: {param.name}")
@@ -356,6 +497,11 @@ def main() -> int:
         action="store_true",
         help="Dump parameter definitions to stdout",
     )
+    parser.add_argument(
+        "--durable",
+        action="store_true",
+        help="Sync the database to disk once all definitions are written",
+    )
     parser.add_argument(
         "--verbose",
         "-v",
@@ -375,14 +521,13 @@ def main() -> int:
     db_dir = outdir / _DB_TOP_DIR
     makedirs(db_dir, exist_ok=True)
 
-    assert params.exists()
-    assert db_dir.exists()
-
     if args.debug_harder:
         global _DEBUG_HARDER
         _DEBUG_HARDER = True
 
     if args.verbose:
+        global _DEBUG_ENABLED
+        _DEBUG_ENABLED = True
         log.setLevel(logging.DEBUG)
         console_handler.setLevel(logging.DEBUG)
 
@@ -390,12 +535,13 @@ def main() -> int:
     if args.dump_parameters:
         dump_kernel_parameters(params)
 
-    write_kernel_parameters(params, db_dir)
+    write_kernel_parameters(params, db_dir, durable=args.durable)
 
     print(params["pci"].name)
     print(params["pci"].fmt)
     print(f"**{params["pci"].desc}**")
-    print(params["pci"].values)
+    print(params["pci"].values or [])
+    return 0
 
 if __name__ == "__main__":
     main()